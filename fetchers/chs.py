@@ -1,20 +1,32 @@
 import pandas as pd
-from numpy import around, nan
+from numpy import around, asarray, nan, ones
 from zeep import Client
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from pandas.tseries.frequencies import to_offset
+from zoneinfo import ZoneInfo
 
-UTC_OFFSET = datetime.utcnow()-datetime.now()
+from .transport import MAX_REQUESTS_PER_HOST, soap_transport
+
+LOCAL_TZ = ZoneInfo('America/Toronto')
 EST_OFFSET = timedelta(hours=-5)
+CHUNK_WORKERS = 4  # concurrent SOAP requests per station
+
+# stations are fetched concurrently too, so cap total requests to CHS
+_request_slots = BoundedSemaphore(MAX_REQUESTS_PER_HOST)
 
 def convert_to_utc(dt):
     '''
     Convert datetime to UTC.
 
     If datetime object is "unaware" this means it doesn't have timezone info
-    associated with it, so it assumes local time
+    associated with it, so it assumes local time (LOCAL_TZ, including
+    daylight saving time)
 
     If datetime object is aware it has timezone info associated with it
-    and it gets replaced with UTC
+    and it gets converted to UTC
 
     Parameters
     ----------
@@ -26,43 +38,34 @@ def convert_to_utc(dt):
     Datetime object in UTC.
 
     '''
-    if dt.tzinfo is None: # assume local standard time
-
-        dt = dt + UTC_OFFSET
-
-    else:
+    if dt.tzinfo is None: # assume local time
 
-        dt = dt.replace(tzinfo=timezone.utc)
+        dt = dt.replace(tzinfo=LOCAL_TZ)
 
-    return dt
+    return dt.astimezone(timezone.utc)
 
 
 def clean_CHS(timeseries):
 
-
-    mean = timeseries.mean()
-    stdev = timeseries.std()
-
     max_chg = 2.5
 
     try:
-        # remove 3x repeated values
-        cond1 = timeseries.diff(1)!=0.0
-        cond2 = timeseries.diff(2)!=0.0
-        timeseries = timeseries.where(cond1 & cond2, nan)
+        d1 = timeseries.diff(1)
+        d2 = timeseries.diff(2)
 
-        # remove values where change exceeds +/- max
-        timeseries = timeseries.where(timeseries.diff(1)<max_chg, nan)
-        timeseries = timeseries.where(timeseries.diff(1)>-1*max_chg, nan)
+        # remove 3x repeated values and values where change exceeds +/- max
+        mask = (d1 != 0.0) & (d2 != 0.0) & (d1.abs() < max_chg)
 
         # should log values removed
 
-        # compute mean and remove the really high or really low values as well
+        # compute mean of remaining values and remove the really high
+        # or really low values as well
+        mean = timeseries[mask].mean()
+        stdev = timeseries[mask].std()
+
+        mask &= (timeseries < mean+4*stdev) & (timeseries > mean-4*stdev)
 
-        # check what values are filtered by reversing sign
-        # timeseries = timeseries.where(timeseries>mean+4*stdev)
-        timeseries = timeseries.where(timeseries<mean+4*stdev)
-        timeseries = timeseries.where(timeseries>mean-4*stdev)
+        timeseries = timeseries.where(mask, nan)
 
     except:
         print('error')
@@ -90,20 +93,33 @@ def resample_chs(df, timestep='default'):
 
     if timestep=='hourly':
 
-        df = df.resample('1H').first()
+        df = df.sort_index()
+        df = df[~df.index.duplicated()]
 
-    elif timestep == 'daily':
+        # contiguous 3-minute data starting on the hour is exactly every
+        # 20th value, so take a strided slice instead of building time bins
+        # (first() skips NaN, so only when there are none)
+        if (len(df) >= 3 and df.index[0].minute == 0
+                and df.notna().all().all()
+                and pd.infer_freq(df.index) == to_offset('3min')):
+
+            df = df.iloc[::20]
 
-        # compute daily means
+        else:
 
-        # make sure enough hours in a day to count
-        min_num_hrs_mask = df.resample("D").count() >= 18
+            df = df.resample('1H').first()
 
-        # resample to compute means
-        df = df.resample("D").mean()
+    elif timestep == 'daily':
+
+        # compute daily means and hour counts in a single grouping pass
+        agg = df.groupby(df.index.floor('D')).agg(['mean', 'count'])
+
+        mean = agg.xs('mean', axis=1, level=1)
+        count = agg.xs('count', axis=1, level=1)
 
-        # use mask to convert days with < min hrs to NaN
-        df = df[min_num_hrs_mask]
+        # make sure enough hours in a day to count, days with < min hrs
+        # become NaN; asfreq keeps days with no data at all, like resample
+        df = mean.where(count >= 18).asfreq('D')
 
         # round levels to 2 decimals
         df = around(df, 2)
@@ -122,10 +138,14 @@ def resample_chs(df, timestep='default'):
     return df
 
 
+@lru_cache(maxsize=1)
 def chs_wsdl():
     '''
     Establishes SOAP client for data retrieval from CHS WSDL
 
+    Result is cached so all stations in a run share one client (and its
+    HTTP session) rather than re-parsing the WSDL for each station.
+
     Returns
     -------
     soap_client :
@@ -137,7 +157,7 @@ def chs_wsdl():
     '''
     CHS_WSDL = 'https://ws-shc.qc.dfo-mpo.gc.ca/observations?wsdl'
 
-    soap_client = Client(CHS_WSDL)
+    soap_client = Client(CHS_WSDL, transport=soap_transport())
 
     for service in soap_client.wsdl.services.values():
         print("Connected to service:", service.name)
@@ -152,7 +172,8 @@ def chs_wsdl():
     return soap_client, station_id_list
 
 
-def fetch_chs_levels(stn_ID, start, end=datetime.utcnow(), timestep='hourly', cd=None):
+def fetch_chs_levels(stn_ID, start, end=None, timestep='hourly', cd=None,
+                     soap_client=None, station_id_list=None):
     '''
     Fetches data for a CHS water level station
     from web services
@@ -164,12 +185,17 @@ def fetch_chs_levels(stn_ID, start, end=datetime.utcnow(), timestep='hourly', cd
     start : datetime object
         Starting date of fetched data.
     end : datetime object, optional
-        Ending date of fetched object. The default is datetime.utcnow().
+        Ending date of fetched object. The default is None, which uses
+        datetime.now() at call time.
     timestep : str, optional
         Timestep of data returned.  Options are "daily", "hourly", "15-min" or
         else 3-minute is returned (the CHS default).
         The function default is 'hourly' since this is the most
         commonly used value.
+    cd : float, optional
+        Chart datum added to levels (e.g., to convert to IGLD).
+    soap_client, station_id_list : optional
+        As returned by chs_wsdl(). The default is None, which uses chs_wsdl().
 
     Returns
     -------
@@ -183,7 +209,14 @@ def fetch_chs_levels(stn_ID, start, end=datetime.utcnow(), timestep='hourly', cd
     except:
         raise ValueError('CHS station ID must be string of length 5')
         
-    soap_client, station_id_list = chs_wsdl()
+    if end is None:
+        end = datetime.now()
+
+    if soap_client is None or station_id_list is None:
+        soap_client, station_id_list = chs_wsdl()
+
+    # bind the operation once rather than looking it up for every request
+    search_op = soap_client.service.search
 
 
     if stn_ID not in station_id_list:
@@ -213,7 +246,7 @@ def fetch_chs_levels(stn_ID, start, end=datetime.utcnow(), timestep='hourly', cd
                       'longitudeMax': -69,
                       'depthMin': 0,    # used for depth of measurements (i.e., underwater)
                       'depthMax': 0,
-                      'dateMin': '2020-01-01 00:00:00',  # placeholders, modified later
+                      'dateMin': '2020-01-01 00:00:00',  # placeholders, set per chunk
                       'dateMax': '2020-01-31 00:00:00',
                       'start': 1,  # start of returned data indexed at 1
                       'sizeMax': 1000,  # max is 1000
@@ -232,79 +265,80 @@ def fetch_chs_levels(stn_ID, start, end=datetime.utcnow(), timestep='hourly', cd
                 # for the end day and then this can be used to compute daily
                 end_utc = end_utc + timedelta(hours=24)
 
-            delta = timedelta(days=1)
+            # the server returns 3-minute data whatever the timestep (there's
+            # no step parameter, filtering is done here), so each request
+            # can span at most just over 2 days before hitting sizeMax = 1000;
+            # 48 hours is 961 values, as wide as safely fits
+            delta = timedelta(hours=48)
 
-            df = pd.DataFrame(columns=['datetime', stn_ID])
-            df = df.set_index('datetime')
+            chunks = []
 
             while start_utc <= end_utc:
 
-                # have to loop through days one day at a time,
-                # the max number of days is just over 2
-                # (since sizeMax = 1000, and 3-minute data returned),
-                # so this ensures everything is retrieved, although it's slow
+                chunks.append((start_utc.strftime("%Y-%m-%d %H:%M:00"),
+                               min(end_utc,
+                                   start_utc+delta).strftime("%Y-%m-%d %H:%M:00")))
+
+                start_utc += delta
 
-                params['dateMin'] = start_utc.strftime("%Y-%m-%d %H:%M:00")
-                params['dateMax'] = min(end_utc,
-                                        start_utc+delta).strftime("%Y-%m-%d %H:%M:00")
+            def fetch_chunk(chunk):
+
+                date_min, date_max = chunk
 
                 print('Fetching {} data from {} to {}'.format(stn_ID,
-                                                              params['dateMin'],
-                                                              params['dateMax']))
-                
-                data = soap_client.service.search(**params)
+                                                              date_min,
+                                                              date_max))
 
-                for water_levels in data['data']:
+                with _request_slots:
+                    return search_op(**{**params,
+                                        'dateMin': date_min,
+                                        'dateMax': date_max})
 
-                    if timestep in ['hourly', 'daily']:
+            raw = []
+            values = []
 
-                        if ':00:00' in water_levels['boundaryDate']['max']:
-                            # print(water_levels['metadata'][0]['value'],
-                            #       water_levels['metadata'][1]['value'],
-                            #       water_levels['boundaryDate']['max'],
-                            #       water_levels['value'])
-                            observed_utc = datetime.strptime(water_levels['boundaryDate']['max'], '%Y-%m-%d %H:%M:00')
-                            # convert utc to eastern standard time
+            # each chunk is a separate round-trip, so request them
+            # concurrently; map keeps results in chunk (ascending) order
+            with ThreadPoolExecutor(max_workers=CHUNK_WORKERS) as ex:
 
-                            observed_est = observed_utc + EST_OFFSET
+                for data in ex.map(fetch_chunk, chunks):
 
-                            water_level=water_levels['value']
+                    raw.extend(w['boundaryDate']['max'] for w in data['data'])
+                    values.extend(w['value'] for w in data['data'])
 
-                            df.at[observed_est, stn_ID] = water_level
+            # parse all observed times at once (numpy's ISO fast path,
+            # falling back to pandas on odd strings)
+            try:
+                ts = pd.DatetimeIndex(asarray(raw, dtype='datetime64[s]'))
+            except ValueError:
+                ts = pd.DatetimeIndex(pd.to_datetime(raw, format='%Y-%m-%d %H:%M:00',
+                                                     errors='coerce'))
 
-                    elif timestep == '15-min':
+            # convert utc to eastern standard time (whole hours, so the
+            # timestep filter below is unaffected)
+            ts = ts + EST_OFFSET
 
-                        times = [':00:00', ':15:00', ':30:00', ':45:00']
+            # keep only times matching the requested timestep
+            if timestep in ['hourly', 'daily']:
+                mask = ts.minute == 0
 
-                        if any(time in water_levels['boundaryDate']['max'] for time in times):
-                            # print(water_levels['metadata'][0]['value'],
-                            #       water_levels['metadata'][1]['value'],
-                            #       water_levels['boundaryDate']['max'],
-                            #       water_levels['value'])
-                            observed_utc = datetime.strptime(water_levels['boundaryDate']['max'], '%Y-%m-%d %H:%M:00')
-                            # convert utc to eastern standard time
+            elif timestep == '15-min':
+                mask = ts.minute.isin([0, 15, 30, 45])
 
-                            observed_est = observed_utc + EST_OFFSET
-                            water_level=water_levels['value']
-                            df.at[observed_est, stn_ID] = water_level
+            else:  # 3-minute
+                mask = ones(len(ts), dtype=bool)
 
-                    else:  # 3-minute
-                        # print(water_levels['metadata'][0]['value'],
-                        #       water_levels['metadata'][1]['value'],
-                        #       water_levels['boundaryDate']['max'],
-                        #       water_levels['value'])
-                        observed_utc = datetime.strptime(water_levels['boundaryDate']['max'], '%Y-%m-%d %H:%M:00')
+            # chunks share their boundary time so it's returned twice,
+            # keep the last one (as overwriting did)
+            mask &= ~ts.duplicated(keep='last')
 
-                        # convert utc to eastern standard time
-                        observed_est = observed_utc + EST_OFFSET
-                        water_level=water_levels['value']
-                        df.at[observed_est, stn_ID] = water_level
+            ts_kept = ts[mask]
 
-                    # need to convert columns from object to float
-                    # not sure why they're object to begin with
-                    df = df.apply(pd.to_numeric, errors ='coerce')
+            # values come back as object so convert to float in a single pass
+            values_kept = pd.to_numeric(values, errors='coerce')[mask]
 
-                start_utc += delta
+            df = pd.DataFrame({stn_ID: values_kept},
+                              index=pd.DatetimeIndex(ts_kept, name='datetime'))
 
             #df = df + cd
 
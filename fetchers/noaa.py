@@ -4,16 +4,37 @@ Created on Wed Apr 22 16:11:33 2020
 @author: jacobb
 """
 import pandas as pd
-from numpy import around
+from numpy import around, asarray
 from zeep import Client
 from datetime import date, datetime, timedelta
+from functools import lru_cache
+from threading import BoundedSemaphore
+from pandas.tseries.frequencies import to_offset
+
+from .transport import MAX_REQUESTS_PER_HOST, soap_transport
+
+# stations are fetched concurrently, so cap total requests to NOAA
+_request_slots = BoundedSemaphore(MAX_REQUESTS_PER_HOST)
 
 def resample_noaa(df, timestep='default'):
     
     if timestep in ['hourly', 'daily']:
         
-        # resample to hourly
-        df = df.resample('1H').first()
+        df = df.sort_index()
+        df = df[~df.index.duplicated()]
+        
+        # resample to hourly; contiguous 6-minute data starting on the hour
+        # is exactly every 10th value, so take a strided slice instead of
+        # building time bins (first() skips NaN, so only when there are none)
+        if (len(df) >= 3 and df.index[0].minute == 0 
+                and df.notna().all().all()
+                and pd.infer_freq(df.index) == to_offset('6min')):
+            
+            df = df.iloc[::10]
+            
+        else:
+            
+            df = df.resample('1H').first()
   
         # compute daily from hourly
         if timestep == 'daily':
@@ -36,7 +57,26 @@ def resample_noaa(df, timestep='default'):
     return df
 
 
-def fetch_noaa_levels(stn_ID, start, end=datetime.now(), timestep='default'):
+@lru_cache(maxsize=1)
+def noaa_wsdl():
+    '''
+    Establishes SOAP client for data retrieval from NOAA WSDL
+
+    Result is cached so all stations in a run share one client (and its
+    HTTP session).
+
+    Returns
+    -------
+    soap_client :
+        wsdl client to fetch NOAA data.
+
+    '''
+    NOAA_WSDL = 'https://opendap.co-ops.nos.noaa.gov/axis/webservices/waterlevelrawsixmin/wsdl/WaterLevelRawSixMin.wsdl'
+
+    return Client(NOAA_WSDL, transport=soap_transport())
+
+
+def fetch_noaa_levels(stn_ID, start, end=None, timestep='default'):
     '''
     Fetches data for a NOAA water level station 
     from web services
@@ -48,7 +88,8 @@ def fetch_noaa_levels(stn_ID, start, end=datetime.now(), timestep='default'):
     start : datetime object
         Starting date of fetched data.
     end : datetime object, optional
-        Ending date of fetched object. The default is datetime.now().
+        Ending date of fetched object. The default is None, which uses
+        datetime.now() at call time.
     timestep : TYPE, optional
         Timestep of data returned.  Options are "daily", "hourly" or 
         else 6-minute is returned (the NOAA default). 
@@ -62,13 +103,17 @@ def fetch_noaa_levels(stn_ID, start, end=datetime.now(), timestep='default'):
 
     '''    
    
+    if end is None:
+        end = datetime.now()
+
     # NOAA data fetched from SOAP
-    
-    NOAA_WSDL = 'https://opendap.co-ops.nos.noaa.gov/axis/webservices/waterlevelrawsixmin/wsdl/WaterLevelRawSixMin.wsdl'
-    soap_client = Client(NOAA_WSDL)
+    soap_client = noaa_wsdl()
+
+    # bind the operation once rather than looking it up for every request
+    fetch_op = soap_client.service.getWaterLevelRawSixMin
 
-    df = pd.DataFrame(columns=['datetime', stn_ID])
-    df = df.set_index('datetime')
+    times = []
+    values = []
     
     max_number_of_days = 30
        
@@ -87,20 +132,30 @@ def fetch_noaa_levels(stn_ID, start, end=datetime.now(), timestep='default'):
         params['beginDate'] = start.strftime('%Y%m%d')
         params['endDate'] = fetch_end.strftime('%Y%m%d')
         
-        data = soap_client.service.getWaterLevelRawSixMin(**params)
+        with _request_slots:
+            data = fetch_op(**params)
         
         start = fetch_end
         
-        for water_levels in data:
-
-            observed_lst = datetime.strptime(water_levels['timeStamp'],
-                                             '%Y-%m-%d %H:%M:00.0')
-
-            water_level=water_levels['WL']
-            
-            # need to convert columns from object to float
-            # ... not sure why they're object to begin with           
-            df.at[observed_lst, stn_ID] = pd.to_numeric(water_level)
+        times.extend(w['timeStamp'] for w in data)
+        values.extend(w['WL'] for w in data)
+    
+    # parse all timestamps at once (numpy's ISO fast path handles the
+    # trailing '.0', falling back to pandas on odd strings)
+    try:
+        times = pd.DatetimeIndex(asarray(times, dtype='datetime64[ms]'))
+    except ValueError:
+        times = pd.DatetimeIndex(pd.to_datetime(times, format='%Y-%m-%d %H:%M:00.0',
+                                                errors='coerce'))
+    
+    # chunks are whole days and share their boundary day so it's returned
+    # twice, keep the last (as overwriting did)
+    keep = ~times.duplicated(keep='last')
+    
+    # build table once after fetching, values come back as
+    # object so convert to float in a single pass
+    df = pd.DataFrame({stn_ID: pd.to_numeric(values, errors='coerce')[keep]},
+                      index=times[keep].rename('datetime'))
     
     df = resample_noaa(df, timestep=timestep)
                 
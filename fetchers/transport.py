@@ -0,0 +1,36 @@
+"""
+HTTP transport factory for the SOAP fetchers
+"""
+import requests
+from requests.adapters import HTTPAdapter
+from zeep.cache import InMemoryCache
+from zeep.transports import Transport
+
+MAX_REQUESTS_PER_HOST = 8  # fetchers hold a semaphore of this size per service
+
+POOL_CONNECTIONS = 8
+POOL_MAXSIZE = MAX_REQUESTS_PER_HOST  # so no connection is discarded after use
+
+
+def soap_transport():
+    '''
+    Builds a zeep transport on a pooled keep-alive requests session
+
+    Each call builds its own session, so each client (CHS, NOAA) gets its own
+    connection pool. Connections are reused across that client's calls so only
+    the first request to a host pays the TLS handshake, and parsed WSDL/XSD
+    documents are cached in memory.
+
+    Returns
+    -------
+    transport : zeep Transport
+        Transport to pass to zeep Client.
+
+    '''
+    session = requests.Session()
+
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                          pool_maxsize=POOL_MAXSIZE)
+    session.mount('https://', adapter)
+
+    return Transport(session=session, cache=InMemoryCache())
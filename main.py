@@ -9,7 +9,9 @@ import logging
 import sqlite3
 import pandas as pd
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
+from functools import lru_cache
 from pathlib import Path
 
 from fetchers import chs
@@ -22,6 +24,11 @@ LOG_PATH = path / 'log.log'
 DB_PATH = path / 'glslr.db'
 STATIONS_PATH = path / 'stations.csv'
 
+EPOCH = pd.Timestamp('1970-01-01')  # datetimes stored as seconds since EPOCH
+STATION_COLUMN_TYPES = {'cd': 'REAL'}  # any other column is TEXT
+
+FETCH_WORKERS = 8  # stations fetched concurrently
+
 def logger_setup():
     """
     Setup program logging
@@ -37,28 +44,37 @@ def logger_setup():
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.DEBUG)
     
-    # Create console and file handlers
-    c_handler = logging.StreamHandler()
-    f_handler = logging.FileHandler(LOG_PATH)
-    c_handler.setLevel(logging.INFO)
-    f_handler.setLevel(logging.WARNING)
-    
-    # Create formatters and add it to handlers
-    c_format = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
-    f_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    c_handler.setFormatter(c_format)
-    f_handler.setFormatter(f_format)
-    
-    # Add handlers to the logger
-    logger.addHandler(c_handler)
-    logger.addHandler(f_handler)
-    
-    logger.info('test')
-    logger.warning('test2')
+    # handlers only added once, even if called again
+    if not logger.handlers:
+        
+        # Create console and file handlers
+        c_handler = logging.StreamHandler()
+        f_handler = logging.FileHandler(LOG_PATH)
+        c_handler.setLevel(logging.INFO)
+        f_handler.setLevel(logging.WARNING)
+        
+        # Create formatters and add it to handlers
+        c_format = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
+        f_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        c_handler.setFormatter(c_format)
+        f_handler.setFormatter(f_format)
+        
+        # Add handlers to the logger
+        logger.addHandler(c_handler)
+        logger.addHandler(f_handler)
         
     return logger
 
 
+def to_epoch_seconds(dt):
+    """ Convert datetime(s) to integer seconds since 1970-01-01 
+    
+        Naive datetimes are converted as-is (i.e., the stored value is in 
+        the same time zone as the data)"""
+    
+    return (pd.DatetimeIndex(dt) - EPOCH) // pd.Timedelta(seconds=1)
+
+
 def table_exists(con, table_name):
     """ Check if table exists in database 
     
@@ -73,6 +89,55 @@ def table_exists(con, table_name):
         return False
 
 
+def migrate_datetimes(con, table_name):
+    """ Convert ISO string datetimes (as stored by earlier versions) to 
+        seconds since EPOCH, once per table 
+    
+        Raises ValueError if some datetimes can't be converted"""
+    
+    if not table_exists(con, table_name):
+        return
+    
+    # sqlite sorts text after all numbers, so this finds string datetimes
+    # with an index search rather than scanning the whole table
+    qry = f'SELECT 1 FROM "{table_name}" WHERE datetime >= \'\' LIMIT 1'
+    
+    if con.execute(qry).fetchone() is None:
+        return
+    
+    logger.info(f"Converting datetimes in table {table_name} to seconds")
+    
+    # strftime treats the string as UTC, so naive values convert as-is
+    # like to_epoch_seconds
+    with con:
+        con.execute(f'UPDATE "{table_name}" '
+                    f"SET datetime = CAST(strftime('%s', datetime) AS INTEGER) "
+                    f"WHERE datetime >= '' "
+                    f"AND strftime('%s', datetime) IS NOT NULL")
+    
+    if con.execute(qry).fetchone() is not None:
+        raise ValueError(f"Table {table_name} has datetimes that can't be "
+                         "converted to seconds; fix or remove those rows")
+
+
+def last_datetime(con, table_name):
+    """ Get latest datetime stored in a station table 
+    
+        Returns Timestamp, or None if table doesn't exist or is empty"""
+    
+    if not table_exists(con, table_name):
+        return None
+    
+    c = con.cursor()
+    last = c.execute(f'SELECT MAX(datetime) FROM "{table_name}"').fetchone()[0]
+    
+    if last is None:
+        return None
+    
+    # datetimes are stored as seconds since EPOCH
+    return EPOCH + pd.Timedelta(seconds=last)
+
+
 def create_table(con, table_name):
     """ Creates table if table doesn't exist
     
@@ -86,13 +151,23 @@ def create_table(con, table_name):
     return table_exists(table_name)
     
 
-def stns_info_to_db(filename):
+@lru_cache(maxsize=1)
+def _load_stations_csv(filename):
+    """ Reads csv station info, cached so the file is only parsed once 
+    
+        Returns dataframe of station info"""
+    
+    return pd.read_csv(filename, dtype={'id':str}) # read 'id' as str, not int
+
+
+def stns_info_to_db(stations):
     """
-    Reads csv station info and inserts to database    
+    Inserts station info to database    
 
     Parameters
     ----------
-    filename : csv file of station info
+    stations : dataframe
+        Station info, e.g., from _load_stations_csv.
 
     Returns
     -------
@@ -101,9 +176,15 @@ def stns_info_to_db(filename):
     """
         
     try:
-        stations = pd.read_csv(filename, dtype={'id':str}) # read 'id' as str, not int
+        # 'id' kept as text, not int; 'cd' needs numeric affinity
+        cols = ', '.join(f'"{col}" {STATION_COLUMN_TYPES.get(col, "TEXT")}'
+                         for col in stations.columns)
         
-        stations.set_index('id').to_sql('stations', con, if_exists='append', index=True)
+        with con:
+            con.execute(f"CREATE TABLE IF NOT EXISTS stations ({cols})")
+            con.executemany(
+                f"INSERT INTO stations VALUES ({','.join('?'*len(stations.columns))})",
+                stations.itertuples(index=False, name=None))
         
         return stations
     
@@ -112,7 +193,7 @@ def stns_info_to_db(filename):
         return False
 
 
-def fetch_stn_data(stn, start, end):
+def fetch_stn_data(stn, start, end, chs_client=None):
     """
     Fetches individual station data from date/time start to date/time end
 
@@ -123,6 +204,9 @@ def fetch_stn_data(stn, start, end):
         Key 'id' is used to fetch correct station from provider.
     start, end : datetime
         Start and end of fetch period.
+    chs_client : tuple, optional
+        (soap_client, station_id_list) from chs.chs_wsdl(), shared between
+        CHS stations. Default = None, fetcher connects itself.
 
     Returns
     -------
@@ -134,10 +218,14 @@ def fetch_stn_data(stn, start, end):
     
     if stn['provider'] == 'CHS':
         
+        soap_client, station_id_list = chs_client or (None, None)
+        
         df = chs.fetch_chs_levels(stn['id'], 
                                   start, end,
                                   timestep='hourly',
-                                  cd=stn['cd'])  # to convert from cd to IGLD
+                                  cd=stn['cd'],  # to convert from cd to IGLD
+                                  soap_client=soap_client,
+                                  station_id_list=station_id_list)
 
     elif stn['provider'] == 'NOAA':
 
@@ -164,19 +252,94 @@ def stns_data_to_db(con, stations, start, end):
     stations : dataframe
         Contains rows of station info.
     start, end : datetime
-        Start and end of fetch period.
+        Start and end of fetch period. Stations with data already stored
+        are only fetched from their latest stored datetime onward.
 
     """
         
-    for ix, stn in stations.iterrows():
+    # connect to CHS once up front so all CHS stations share the client
+    chs_client = None
+    chs_failed = False
 
-        name = stn['name']
-        logger.info(f"Station {str(ix+1)} of {len(stations)}: fetch data for {name}")
-        
-        df = fetch_stn_data(stn, start, end)
+    if (stations['provider'] == 'CHS').any():
+        try:
+            chs_client = chs.chs_wsdl()
+        except Exception:
+            logger.error("Connection to CHS failed; skipping CHS stations", exc_info=True)
+            chs_failed = True
+
+    # fetching is network bound so run stations concurrently, results are
+    # written from this thread as they complete since sqlite connections
+    # can't be shared across threads
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as ex:
+
+        futures = {}
+
+        for ix, stn in enumerate(stations.to_dict('records')):
+
+            name = stn['name']
+
+            if chs_failed and stn['provider'] == 'CHS':
+                continue
+
+            # only fetch what's newer than data already in the database
+            try:
+                migrate_datetimes(con, str(stn['id']))
+            except ValueError:
+                logger.error(f"Skipping {name}", exc_info=True)
+                continue
+
+            last = last_datetime(con, str(stn['id']))
+            fetch_start = start
+
+            if last is not None:
+                fetch_start = max(start, (last + timedelta(hours=1)).to_pydatetime())
 
-        if df is not None:
-            df.to_sql(str(stn['id']), con, if_exists='append', index=True)
+            if fetch_start >= end:
+                logger.info(f"Station {str(ix+1)} of {len(stations)}: {name} up to date")
+                continue
+
+            logger.info(f"Station {str(ix+1)} of {len(stations)}: fetch data for {name}")
+
+            futures[ex.submit(fetch_stn_data, stn, fetch_start, end, chs_client)] = (stn, last)
+
+        # single transaction for all station writes; to_sql would commit
+        # after each station, so insert directly with executemany
+        with con:
+
+            for fut in as_completed(futures):
+
+                stn, last = futures[fut]
+
+                # one failed station shouldn't lose the others
+                try:
+                    df = fut.result()
+                except Exception:
+                    logger.error(f"Error fetching data for {stn['name']}", exc_info=True)
+                    continue
+
+                # fetchers may return whole days, drop anything already stored
+                if df is not None and last is not None:
+                    df = df[df.index > last]
+
+                if df is not None:
+                    stn_id = str(stn['id'])
+
+                    cols = ', '.join(f'"{col}" REAL' for col in df.columns)
+
+                    con.execute(f'CREATE TABLE IF NOT EXISTS "{stn_id}" '
+                                f'("datetime" INTEGER, {cols})')
+                    con.execute(f'CREATE INDEX IF NOT EXISTS "ix_{stn_id}_datetime" '
+                                f'ON "{stn_id}"(datetime)')
+
+                    # store datetimes as integer seconds, faster to compare
+                    # and index than ISO strings
+                    rows = zip(to_epoch_seconds(df.index).tolist(),
+                               *(df[col].tolist() for col in df.columns))
+
+                    con.executemany(
+                        f'INSERT INTO "{stn_id}" VALUES ({",".join("?"*(len(df.columns)+1))})',
+                        rows)
 
 
 
@@ -200,7 +363,7 @@ def get_datatable(con, table_name, start=None, end=None):
 
     """
     
-    qry = "SELECT * FROM '{}'"
+    qry = 'SELECT * FROM "{}"'
     
     params = []
     
@@ -209,21 +372,25 @@ def get_datatable(con, table_name, start=None, end=None):
         
         if start:
             qry = qry + " WHERE datetime >= ?"
-            params.append(start)
+            params.append(int(to_epoch_seconds([start])[0]))
             
             if end:
                 qry = qry + " AND datetime <= ?"
-                params.append(end)     
+                params.append(int(to_epoch_seconds([end])[0]))
                 
         elif end:
             
             qry = qry + " WHERE datetime <= ?"
-            params.append(end)
+            params.append(int(to_epoch_seconds([end])[0]))
             
         qry += ";"
     
         df = pd.read_sql_query(qry.format(table_name), con, params=params)
         
+        # datetimes are stored as seconds since EPOCH
+        if 'datetime' in df:
+            df['datetime'] = pd.to_datetime(df['datetime'], unit='s')
+        
         return df
         
     else:
@@ -239,6 +406,8 @@ if __name__ == '__main__':
     logger.info('Connecting to database')
     try:
         con = sqlite3.connect(DB_PATH)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
     except Exception as e:
         logger.error('Connection to database failed', exc_info=True)
         
@@ -246,11 +415,11 @@ if __name__ == '__main__':
     end = datetime.now()
     start = datetime.today()-timedelta(days=3)
 
+    stations = _load_stations_csv(STATIONS_PATH)
+
     # add station info if doesn't exist, also builds db if doesn't exist
     if table_exists(con, 'stations') is False:
-        stations = stns_info_to_db(STATIONS_PATH)
-    else:
-        stations = get_datatable(con, 'stations') 
+        stns_info_to_db(stations)
     
     # fetch data and populate database       
     stns_data_to_db(con, stations, start, end)